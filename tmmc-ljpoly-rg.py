@@ -3,11 +3,28 @@
 import numpy as np
 import math
 import os
-import random
+import sys
+import re
+import mmap
 import itertools 
 import json 
+import functools
+import warnings
 import matplotlib.pyplot as plt 
-from types import SimpleNamespace # For sim_config object
+from types import SimpleNamespace, ModuleType # For sim_config object
+try:
+    from numba import njit # Optional: JIT-compiles the hot energy kernels
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+    def njit(*args, **kwargs): # No-op stand-in so jitted kernels still define as plain Python
+        if len(args) == 1 and callable(args[0]): return args[0]
+        return lambda func: func
+try:
+    import orjson # Optional: serializes the summary (NumPy arrays included) in C
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
 
 # --- Global Constants & Configuration Placeholders ---
 KB = 1.0 # Assuming reduced units for simulation
@@ -50,6 +67,7 @@ def create_input_config_json(filename="input_config.json"):
         "eta_update_frequency": 500,      # In terms of outer GEE blocks
         "eta_damping_factor": 0.2,
         "solvent_max_displacement": 0.15, # In units of sigma
+        "solvent_cutoff": None, # Solvent-solvent LJ cutoff in sigma (e.g. 2.5); None keeps all pairs
         "num_processors": 1, # For potential future parallelization hints
         "plot_data_log_freq": 200, # Log plotting data every N elementary steps (sweeps)
         "verbose_print_freq": 1000 # Print verbose output every N elementary steps (sweeps)
@@ -75,16 +93,22 @@ DEFAULT_CONFIG_PY = {
     "num_solvent_particles": 0, "solvent_density": 0.7, 
     "eps_ss": 1.0, "sigma_ss": 1.0, "box_side_length": 8.9,
     "eps_ms": 1.0, "sigma_ms": 1.0,
-    "cv_type": "Rg", "num_cv_bins": 49, "cv_min": None, "cv_max": None,
+    "cv_type": "Rg", "num_cv_bins": 49, "cv_min": None, "cv_max": None, "cv_bin_width": None, # cv_bin_width: derived from the CV range at run time
     "num_growth_stages": 31,
     "mc_equilibration_cycles": 1000, "mc_production_cycles": 2000,
     "solvent_sweeps_per_gee_attempt": 10,
     "eta_update_frequency": 100, "eta_damping_factor": 0.2,
-    "solvent_max_displacement": 0.15, "num_processors": 1,
+    "solvent_max_displacement": 0.15, "solvent_cutoff": None, "num_processors": 1,
     "plot_data_log_freq": 100, "verbose_print_freq": 500,
     "KB": 1.0 # Reduced Boltzmann constant
 }
 
+CONFIG_KEYS_NOT_SAVED = {'KB', 'KB_REDUCED', 'LOG2', 'gee_attempt_details_log', 'mc_cycle_history_log'} # Constants / derived values
+
+def _serializable_config_keys(config_obj):
+    return tuple(k for k, v in vars(config_obj).items()
+                 if not k.startswith('_') and not callable(v) and not isinstance(v, ModuleType) and k not in CONFIG_KEYS_NOT_SAVED)
+
 def load_simulation_config(config_file_path):
     config_data = DEFAULT_CONFIG_PY.copy()
     try:
@@ -118,76 +142,168 @@ def load_simulation_config(config_file_path):
         config_namespace.eta_damping_factor = 0.2
     if not hasattr(config_namespace, 'KB'): # Add KB if not in json
         config_namespace.KB = 1.0
+    config_namespace.LOG2 = math.log(2.0) # Boundary-stage correction used by every GEE attempt; derived, not saved
+    config_namespace._serializable_keys = _serializable_config_keys(config_namespace) # Fixed key set for the summary's config_used
 
 
     return config_namespace
 
 # --- Cell 3 Logic: Library Processing ---
 # Helper functions for Cell 3 (Energies & CV)
-def calculate_distance_sq_c3(p1, p2): return np.sum((p1 - p2)**2)
-def calculate_distance_c3(p1, p2): return np.sqrt(calculate_distance_sq_c3(p1, p2))
+@functools.lru_cache(maxsize=None)
+def _triu_pair_indices(n, k): return np.triu_indices(n, k=k) # Pair lists depend only on (N, offset); build once
 def calculate_bonded_energy_c3(coords, k_harmonic, r_eq_harmonic):
-    E = 0.0; N = len(coords)
+    coords = np.asarray(coords, dtype=np.float64); N = len(coords)
     if N < 2: return 0.0
-    for i in range(N - 1): E += 0.5 * k_harmonic * (calculate_distance_c3(coords[i], coords[i+1]) - r_eq_harmonic)**2
-    return E
-def calculate_lj_energy_pair_c3(r_sq, epsilon, sigma):
-    if r_sq < 1e-12: return 1e10
-    sig_sq_over_r_sq = (sigma**2) / r_sq; sr6 = sig_sq_over_r_sq**3; sr12 = sr6**2
-    return 4.0 * epsilon * (sr12 - sr6)
+    r = np.linalg.norm(coords[1:] - coords[:-1], axis=1) # All N-1 bond lengths at once
+    return float(0.5 * k_harmonic * np.sum((r - r_eq_harmonic)**2))
 def calculate_non_bonded_energy_c3(coords, epsilon_pp, sigma_pp):
-    E = 0.0; N = len(coords)
+    coords = np.asarray(coords, dtype=np.float64); N = len(coords)
     if N < 3: return 0.0 # For j >= i+2
+    idx_i, idx_j = _triu_pair_indices(N, 2) # All (i, j>=i+2) pairs in one shot
+    d = coords[idx_j] - coords[idx_i]; r_sq = np.einsum('ij,ij->i', d, d)
+    overlap = r_sq < 1e-12 # Same 1e10 overlap penalty as _internal_energy_nb and _lj_energy_sum_c4
+    sr6 = ((sigma_pp**2) / np.where(overlap, 1.0, r_sq))**3
+    return float(np.sum(np.where(overlap, 1e10, 4.0 * epsilon_pp * (sr6**2 - sr6))))
+@njit(cache=True, fastmath=True)
+def _internal_energy_nb(coords, k_harmonic, r_eq_harmonic, epsilon_pp, sigma_pp):
+    # Bonded + non-bonded (j >= i+2) vacuum energy in one allocation-free pass
+    E = 0.0; N = coords.shape[0]; sigma_sq = sigma_pp * sigma_pp
+    for i in range(N - 1):
+        dx = coords[i+1, 0] - coords[i, 0]; dy = coords[i+1, 1] - coords[i, 1]; dz = coords[i+1, 2] - coords[i, 2]
+        dr = math.sqrt(dx*dx + dy*dy + dz*dz) - r_eq_harmonic
+        E += 0.5 * k_harmonic * dr * dr
     for i in range(N):
-        for j in range(i + 2, N): E += calculate_lj_energy_pair_c3(calculate_distance_sq_c3(coords[i], coords[j]), epsilon_pp, sigma_pp)
+        for j in range(i + 2, N):
+            dx = coords[j, 0] - coords[i, 0]; dy = coords[j, 1] - coords[i, 1]; dz = coords[j, 2] - coords[i, 2]
+            r_sq = dx*dx + dy*dy + dz*dz
+            if r_sq < 1e-12: E += 1e10; continue
+            sr6 = (sigma_sq / r_sq)**3
+            E += 4.0 * epsilon_pp * (sr6 * sr6 - sr6)
+    return E
+@njit(cache=True, fastmath=True)
+def _internal_energy_batch_nb(all_coords, k_harmonic, r_eq_harmonic, epsilon_pp, sigma_pp):
+    # _internal_energy_nb over an (M, N, 3) stack: no (M, pairs) temporaries
+    E = np.empty(all_coords.shape[0])
+    for m in range(all_coords.shape[0]): E[m] = _internal_energy_nb(all_coords[m], k_harmonic, r_eq_harmonic, epsilon_pp, sigma_pp)
     return E
 def calculate_total_internal_energy_c3(coords, config):
+    if NUMBA_AVAILABLE:
+        return _internal_energy_nb(np.ascontiguousarray(coords, dtype=np.float64), float(config.k_harmonic),
+                                   float(config.r_eq_harmonic), float(config.eps_pp), float(config.sigma_pp))
     return calculate_bonded_energy_c3(coords, config.k_harmonic, config.r_eq_harmonic) + \
            calculate_non_bonded_energy_c3(coords, config.eps_pp, config.sigma_pp)
 def calculate_cv_rg_first_monomer_origin_c3(coords, cv_type="Rg"):
-    coords_arr = np.array(coords); N = len(coords_arr)
+    coords_arr = coords if isinstance(coords, np.ndarray) else np.array(coords); N = len(coords_arr)
     if N == 0: return 0.0
     if cv_type.lower() == "rg":
-        origin = coords_arr[0]; rg_sq = 0.0
-        for i in range(N): rg_sq += np.sum((coords_arr[i] - origin)**2)
-        return np.sqrt(rg_sq / N) if N > 0 else 0.0
+        d = coords_arr - coords_arr[0] # Offsets from the first monomer (origin)
+        return np.sqrt(np.einsum('ij,ij->', d, d) / N)
     elif cv_type.lower() == "end_to_end_distance":
-        return calculate_distance_c3(coords_arr[0], coords_arr[-1]) if N >= 2 else 0.0
+        if N < 2: return 0.0
+        d = coords_arr[-1] - coords_arr[0]; return math.sqrt(d.dot(d))
     raise ValueError(f"Unsupported CV type: {cv_type}")
 
+def _parse_coord_block_c3(coord_text, num_monomers_per_conf):
+    # One C-level parse for a whole conformation block (bytes); None if it is not exactly N x 3 floats.
+    # Only counts values: callers check 3 columns per line first (_ROWS3_RE_C3)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", DeprecationWarning) # numpy flags a partial parse via DeprecationWarning
+        try: flat = np.fromstring(coord_text, dtype=np.float64, sep=' ')
+        except (ValueError, DeprecationWarning): return None
+    return flat.reshape(num_monomers_per_conf, 3) if flat.size == 3 * num_monomers_per_conf else None
+
+_CONF_TAG_RE_C3 = re.compile(rb'^[ \t]*# Conformation', re.MULTILINE)
+_BLANK_LINE_RE_C3 = re.compile(rb'\n\s*\n')
+_ROW3_C3 = rb'[ \t]*\S+[ \t]+\S+[ \t]+\S+[ \t\r]*' # One coordinate line: exactly three whitespace-separated fields
+_ROWS3_RE_C3 = re.compile(rb'(?:' + _ROW3_C3 + rb'\n)*' + _ROW3_C3) # Whole block, every line three fields (single C-level match)
+
 def yield_polymer_conformations_new_format_c3(library_file_path, num_monomers_per_conf):
-    conf_idx = 0; current_conf_coords = []; reading_conf = False; start_ln_for_conf = -1
+    # Whole file mapped once; blocks located by their '# Conformation' tags and each parsed in one call.
+    # Same contract as the line reader: first N non-blank lines after a tag, 1-based tag line numbers
+    conf_idx = 0
     try:
-        with open(library_file_path, 'r') as f:
-            for current_ln, line_content in enumerate(f, 1):
-                line = line_content.strip()
-                if line.startswith("# Conformation"):
-                    if reading_conf and len(current_conf_coords) < num_monomers_per_conf:
-                        print(f"Warning: Incomplete conf (started L{start_ln_for_conf}) before new tag L{current_ln}. Skipping.")
-                    current_conf_coords = []; reading_conf = True; start_ln_for_conf = current_ln
-                    continue
-                if reading_conf:
-                    if not line: continue
-                    parts = line.split()
-                    if len(parts) == 3:
-                        try:
-                            current_conf_coords.append([float(p) for p in parts])
-                            if len(current_conf_coords) == num_monomers_per_conf:
-                                yield conf_idx, start_ln_for_conf, np.array(current_conf_coords)
-                                conf_idx += 1; current_conf_coords = []; reading_conf = False; start_ln_for_conf = -1
-                        except ValueError:
-                            print(f"Warning: Parse error L{current_ln}: '{line_content.strip()}'. Skipping conf block (L{start_ln_for_conf}).")
-                            current_conf_coords = []; reading_conf = False; start_ln_for_conf = -1
+        with open(library_file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0: return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                tag_starts = [m.start() for m in _CONF_TAG_RE_C3.finditer(data)]
+                ln = 1 + data[:tag_starts[0]].count(b'\n') if tag_starts else 1
+                for t, tag_pos in enumerate(tag_starts):
+                    block = data[tag_pos:tag_starts[t + 1] if t + 1 < len(tag_starts) else len(data)]
+                    start_ln_for_conf = ln; ln += block.count(b'\n') # ln now at the next tag
+                    tag_end = block.find(b'\n'); body = block[tag_end + 1:].strip() if tag_end >= 0 else b''
+                    if body.count(b'\n') == num_monomers_per_conf - 1 and not _BLANK_LINE_RE_C3.search(body) and _ROWS3_RE_C3.fullmatch(body): # Common case: exactly N lines of 3
+                        coords = _parse_coord_block_c3(body, num_monomers_per_conf)
+                        if coords is not None: yield conf_idx, start_ln_for_conf, coords; conf_idx += 1; continue
+                    # Irregular block: line by line, first bad line drops the block with the same warnings as before
+                    raw_lines = block[tag_end + 1:].split(b'\n') if tag_end >= 0 else []
+                    kept = [i for i, l in enumerate(raw_lines) if l.strip()][:num_monomers_per_conf]; rows = []
+                    for i in kept:
+                        parts = raw_lines[i].split(); bad_line = raw_lines[i].decode(errors='replace').strip()
+                        if len(parts) != 3: print(f"Warning: Format error L{start_ln_for_conf + 1 + i}: '{bad_line}'. Skipping conf block (L{start_ln_for_conf})."); break
+                        try: rows.append([float(p) for p in parts])
+                        except ValueError: print(f"Warning: Parse error L{start_ln_for_conf + 1 + i}: '{bad_line}'. Skipping conf block (L{start_ln_for_conf})."); break
                     else:
-                        print(f"Warning: Format error L{current_ln}: '{line_content.strip()}'. Skipping conf block (L{start_ln_for_conf}).")
-                        current_conf_coords = []; reading_conf = False; start_ln_for_conf = -1
-            if reading_conf and current_conf_coords and len(current_conf_coords) < num_monomers_per_conf:
-                print(f"Warning: EOF. Last conf (L{start_ln_for_conf}) incomplete. Skipping.")
+                        if len(rows) == num_monomers_per_conf: yield conf_idx, start_ln_for_conf, np.array(rows); conf_idx += 1
+                        elif t + 1 < len(tag_starts): print(f"Warning: Incomplete conf (started L{start_ln_for_conf}) before new tag L{ln}. Skipping.")
+                        elif rows: print(f"Warning: EOF. Last conf (L{start_ln_for_conf}) incomplete. Skipping.")
     except FileNotFoundError: print(f"ERROR: Library file '{library_file_path}' not found."); yield None
     except Exception as e: print(f"ERROR reading library: {e}"); yield None
 
+LIBRARY_BATCH_SIZE = 4096 # Max conformations stacked per (M, N, 3) batch in Cell 3
+LIBRARY_BATCH_BYTES = 64 * 2**20 # NumPy energy path: one batch's (M, pairs, 3) float64 displacements; its (M, pairs) temporaries bring the peak to ~3x
+
+def _library_batch_size(num_monomers):
+    # The NumPy non-bonded step allocates O(M * N^2), so bound the batch by pair count; the Numba kernel only needs the stack
+    if NUMBA_AVAILABLE: return LIBRARY_BATCH_SIZE
+    num_pairs = max(1, num_monomers * (num_monomers - 1) // 2)
+    return int(min(LIBRARY_BATCH_SIZE, max(1, LIBRARY_BATCH_BYTES // (num_pairs * 3 * 8))))
+
+def calculate_cv_batch_c3(all_coords, cv_type="Rg"):
+    # Batched calculate_cv_rg_first_monomer_origin_c3 over an (M, N, 3) stack
+    M, N = all_coords.shape[0], all_coords.shape[1]
+    if N == 0: return np.zeros(M)
+    if cv_type.lower() == "rg":
+        d = all_coords - all_coords[:, 0:1, :]
+        return np.sqrt(np.einsum('mij,mij->m', d, d) / N)
+    elif cv_type.lower() == "end_to_end_distance":
+        if N < 2: return np.zeros(M)
+        d = all_coords[:, -1, :] - all_coords[:, 0, :]
+        return np.sqrt(np.einsum('mi,mi->m', d, d))
+    raise ValueError(f"Unsupported CV type: {cv_type}")
+
+def calculate_total_internal_energy_batch_c3(all_coords, config):
+    # Batched calculate_total_internal_energy_c3 over an (M, N, 3) stack
+    if NUMBA_AVAILABLE:
+        return _internal_energy_batch_nb(np.ascontiguousarray(all_coords, dtype=np.float64), float(config.k_harmonic),
+                                         float(config.r_eq_harmonic), float(config.eps_pp), float(config.sigma_pp))
+    M, N = all_coords.shape[0], all_coords.shape[1]; E = np.zeros(M)
+    if N >= 2:
+        r = np.linalg.norm(all_coords[:, 1:, :] - all_coords[:, :-1, :], axis=-1)
+        E += 0.5 * config.k_harmonic * np.sum((r - config.r_eq_harmonic)**2, axis=1)
+    if N >= 3:
+        idx_i, idx_j = _triu_pair_indices(N, 2)
+        d = all_coords[:, idx_j, :] - all_coords[:, idx_i, :]; r_sq = np.einsum('mpk,mpk->mp', d, d)
+        overlap = r_sq < 1e-12; sr6 = ((config.sigma_pp**2) / np.where(overlap, 1.0, r_sq))**3
+        E += np.sum(np.where(overlap, 1e10, 4.0 * config.eps_pp * (sr6**2 - sr6)), axis=1)
+    return E
+
+def _process_library_batch_c3(batch_meta, batch_coords, config_obj):
+    # CV + energy for a whole batch at once; falls back to per-conformation so one bad entry only drops itself
+    try:
+        all_coords = np.stack(batch_coords)
+        rows = zip(batch_meta, calculate_cv_batch_c3(all_coords, config_obj.cv_type), calculate_total_internal_energy_batch_c3(all_coords, config_obj))
+    except Exception:
+        rows = []
+        for (original_idx, start_ln), coords in zip(batch_meta, batch_coords):
+            try: rows.append(((original_idx, start_ln), calculate_cv_rg_first_monomer_origin_c3(coords, config_obj.cv_type), calculate_total_internal_energy_c3(coords, config_obj)))
+            except Exception as e: print(f"Err CV/Energy for conf idx {original_idx} (L{start_ln}): {e}")
+    return [{"original_index": original_idx, "start_line_num": start_ln, "cv": float(cv_val), "energy": float(total_E)}
+            for (original_idx, start_ln), cv_val, total_E in rows]
+
 def process_library_cell3(config_obj): # Renamed sim_config to config_obj
     print("\n--- Cell 3 part: Processing Polymer Library ---")
+    _load_conf_cached.cache_clear() # The library file may have been replaced since the last run
     if not config_obj: print("ERROR: sim_config not loaded. Cannot run Cell 3 part."); return False
     
     print(f"Using: Library='{config_obj.conformation_library_file}', CV='{config_obj.cv_type}'")
@@ -198,16 +314,20 @@ def process_library_cell3(config_obj): # Renamed sim_config to config_obj
         print(f"ERROR: Library file '{config_obj.conformation_library_file}' does not exist."); return False
 
     conf_gen = yield_polymer_conformations_new_format_c3(config_obj.conformation_library_file, config_obj.num_monomers)
-    for item in conf_gen:
+    batch_meta = []; batch_coords = []; batch_size = _library_batch_size(config_obj.num_monomers)
+    for item in itertools.chain(conf_gen, [()]): # Trailing () flushes the last partial batch
         if item is None: error_flag_c3 = True; break
-        original_idx, start_ln, coords = item
-        try:
-            cv_val = calculate_cv_rg_first_monomer_origin_c3(coords, config_obj.cv_type)
-            total_E = calculate_total_internal_energy_c3(coords, config_obj)
-        except Exception as e: print(f"Err CV/Energy for conf idx {original_idx} (L{start_ln}): {e}"); continue
-        processed_data.append({"original_index": original_idx, "start_line_num": start_ln, "cv": cv_val, "energy": total_E})
-        processed_count += 1; min_cv_obs = min(min_cv_obs, cv_val); max_cv_obs = max(max_cv_obs, cv_val)
-        if processed_count % 1000 == 0: print(f"  Cell 3: Processed {processed_count} configurations...")
+        if item:
+            original_idx, start_ln, coords = item
+            batch_meta.append((original_idx, start_ln)); batch_coords.append(coords)
+            if len(batch_coords) < batch_size: continue
+        if not batch_coords: continue
+        batch_results = _process_library_batch_c3(batch_meta, batch_coords, config_obj)
+        processed_data.extend(batch_results); processed_count += len(batch_results)
+        if batch_results:
+            min_cv_obs = min(min_cv_obs, min(r["cv"] for r in batch_results)); max_cv_obs = max(max_cv_obs, max(r["cv"] for r in batch_results))
+        print(f"  Cell 3: Processed {processed_count} configurations...")
+        batch_meta = []; batch_coords = []
     
     if error_flag_c3: print("Cell 3: Processing stopped due to file reading error."); return False
     print(f"Cell 3: Finished processing. Processed {processed_count} valid configurations.")
@@ -222,7 +342,7 @@ def process_library_cell3(config_obj): # Renamed sim_config to config_obj
         if abs(config_obj.cv_max - config_obj.cv_min) < 1e-9: config_obj.cv_bin_width = 0.0
         elif config_obj.num_cv_bins > 0: config_obj.cv_bin_width = (config_obj.cv_max - config_obj.cv_min) / config_obj.num_cv_bins
         else: config_obj.cv_bin_width = 0.0
-        if updated_cv or config_obj.cv_bin_width is None: print(f"  Updated sim_config.cv_bin_width to: {config_obj.cv_bin_width:.6f if config_obj.cv_bin_width is not None else 'N/A'}")
+        if updated_cv: print(f"  Updated sim_config.cv_bin_width to: {config_obj.cv_bin_width:.6f}")
 
         out_fname = "library_processed_index.txt"
         out_path = os.path.join(config_obj.output_dir, out_fname)
@@ -235,9 +355,51 @@ def process_library_cell3(config_obj): # Renamed sim_config to config_obj
                 for item_data in processed_data_sorted: f_out.write(f"{item_data['original_index']} {item_data['start_line_num']} {item_data['cv']:.6f} {item_data['energy']:.6f}\n")
             print(f"Cell 3: Successfully wrote index for {len(processed_data_sorted)} configurations.")
         except IOError as e: print(f"Cell 3 ERROR: Could not write output file '{out_path}': {e}"); return False
+        write_library_bin_offsets(np.array([float(f"{d['cv']:.6f}") for d in processed_data_sorted]), config_obj) # Bin the CVs exactly as written
         return True
     else: print("Cell 3: No valid configurations processed. Output file not written."); return False
 
+LIBRARY_BIN_OFFSETS_FNAME = "library_bin_offsets.npz" # Per-bin row ranges of library_processed_index.txt
+LIBRARY_INDEX_DTYPE = [("original_index", "i8"), ("start_line_num", "i8"), ("cv", "f8"), ("energy", "f8")] # Columns of library_processed_index.txt
+
+def _library_bin_edges(config_obj): return np.linspace(config_obj.cv_min, config_obj.cv_max, config_obj.num_cv_bins + 1)
+
+def library_cv_bins(cv_values, config_obj):
+    # The one CV -> bin rule, shared by Cell 3's offsets file and Cell 4's re-binning: floor((cv - cv_min) / width) clipped
+    # to the bin range; a zero-width range keeps only rows inside [cv_min, cv_max], all in bin 0 (others get -1).
+    # Returns (bin_idx per row, order, offsets): rows of bin b are order[offsets[b]:offsets[b+1]]
+    cv = np.asarray(cv_values, dtype=np.float64); num_bins = config_obj.num_cv_bins
+    if (config_obj.cv_bin_width or 0.0) > 1e-9:
+        bin_idx = np.clip(np.floor((cv - config_obj.cv_min) / config_obj.cv_bin_width).astype(np.int64), 0, num_bins - 1)
+    else: bin_idx = np.where((config_obj.cv_min - 1e-9 <= cv) & (cv <= config_obj.cv_max + 1e-9), 0, -1)
+    rows = np.flatnonzero(bin_idx >= 0)
+    order = rows[np.argsort(bin_idx[rows], kind='stable')]
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(bin_idx[rows], minlength=num_bins))))
+    return bin_idx, order, offsets
+
+def write_library_bin_offsets(cvs_sorted, config_obj):
+    # Bin the (CV-sorted) index rows once, from the CV values as written to the index
+    if not config_obj.cv_bin_width or config_obj.cv_bin_width <= 1e-9 or config_obj.num_cv_bins <= 0: return False
+    edges = _library_bin_edges(config_obj)
+    bin_idx, order, offsets = library_cv_bins(cvs_sorted, config_obj)
+    bins_path = os.path.join(config_obj.output_dir, LIBRARY_BIN_OFFSETS_FNAME)
+    try: np.savez(bins_path, edges=edges, bin_idx=bin_idx, order=order, offsets=offsets)
+    except IOError as e: print(f"Cell 3 WARNING: Could not write bin offsets '{bins_path}': {e}"); return False
+    print(f"Cell 3: Wrote per-bin offsets for {config_obj.num_cv_bins} CV bins to: {bins_path}")
+    return True
+
+def load_library_bin_offsets(config_obj, num_index_entries):
+    # (order, offsets) from Cell 3, or None if missing or binned with a different CV grid / index
+    bins_path = os.path.join(config_obj.output_dir, LIBRARY_BIN_OFFSETS_FNAME)
+    if not os.path.exists(bins_path) or not config_obj.cv_bin_width or config_obj.cv_bin_width <= 1e-9: return None
+    try:
+        with np.load(bins_path) as bin_data:
+            edges, order, offsets = bin_data["edges"], bin_data["order"], bin_data["offsets"]
+    except (IOError, KeyError, ValueError) as e: print(f"Warning: Could not read '{bins_path}': {e}. Re-binning."); return None
+    if len(order) != num_index_entries or edges.shape != (config_obj.num_cv_bins + 1,) or \
+       not np.allclose(edges, _library_bin_edges(config_obj), rtol=0.0, atol=1e-12): return None
+    return order, offsets
+
 # --- Cell 4 Logic: TMMC-GEE Simulation ---
 # (Helper functions for Cell 4 are defined globally now, or use Cell 3 versions if names don't clash)
 # (GEE_TMMC_Simulator_Cell4 and FreeEnergyCalculator_Cell4 classes as provided in last full Cell 4 response)
@@ -251,93 +413,266 @@ def process_library_cell3(config_obj): # Renamed sim_config to config_obj
 # (Re-defining calculation functions for Cell 4 to avoid potential conflicts if cells run out of order,
 #  though it's better if they are defined once globally if identical)
 
-def calculate_lj_energy_pair_modified_c4(r_sq, lambda_val, epsilon_ms, sigma_ms): # Renamed to avoid clash
-    if r_sq < 1e-12: return 1e10 if lambda_val > 1e-9 else 0.0
-    sigma_sq_over_r_sq = (sigma_ms**2) / r_sq; sr6 = sigma_sq_over_r_sq**3
-    denominator_base = 0.5 * ((1.0 - lambda_val)**2) + sr6
-    if abs(denominator_base) < 1e-12 : return 1e10 if lambda_val > 1e-9 else 0.0
-    return 4.0 * lambda_val * epsilon_ms * (1.0 / (denominator_base**2) - 1.0 / denominator_base)
-
 def calculate_polymer_solvent_interaction_c4(polymer_coords, solvent_coords, lambda_val, eps_ms, sigma_ms):
-    E = 0.0; Npoly=len(polymer_coords);Nsol=len(solvent_coords)
-    if Nsol == 0: return 0.0
-    for i in range(Npoly): E += sum(calculate_lj_energy_pair_modified_c4(calculate_distance_sq(polymer_coords[i], solvent_coords[k]), lambda_val, eps_ms, sigma_ms) for k in range(Nsol))
-    return E
-
-def calculate_lj_energy_pair_standard_c4(r_sq, epsilon, sigma):
-    if r_sq < 1e-12: return 1e10; sigma_sq = sigma**2; inv_r_sq = 1.0 / r_sq
-    sr6 = (sigma_sq * inv_r_sq)**3; sr12 = sr6**2
-    return 4.0 * epsilon * (sr12 - sr6)
+    if len(solvent_coords) == 0 or lambda_val < 1e-9: return 0.0 # Solute fully decoupled at lambda=0
+    polymer_coords = np.ascontiguousarray(polymer_coords, dtype=np.float64); solvent_coords = np.ascontiguousarray(solvent_coords, dtype=np.float64)
+    dr = polymer_coords[:, None, :] - solvent_coords[None, :, :]; r_sq = np.einsum('ijk,ijk->ij', dr, dr) # (Npoly, Nsol) grid
+    sr6 = ((sigma_ms**2) / np.where(r_sq < 1e-12, 1.0, r_sq))**3
+    denominator_base = 0.5 * ((1.0 - lambda_val)**2) + sr6
+    blown_up = (r_sq < 1e-12) | (np.abs(denominator_base) < 1e-12) # Same 1e10 guards as _solvent_particle_energy_nb
+    denominator_base = np.where(blown_up, 1.0, denominator_base)
+    return float(np.sum(np.where(blown_up, 1e10, 4.0 * lambda_val * eps_ms * (1.0 / (denominator_base**2) - 1.0 / denominator_base))))
 
 def calculate_solvent_solvent_energy_c4(solvent_coords, eps_ss, sigma_ss, box_dim_arr, cutoff_sq=None):
-    E=0.0;Nsol=len(solvent_coords)
+    Nsol=len(solvent_coords)
     if Nsol < 2: return 0.0
-    for i in range(Nsol):
-        for j in range(i+1, Nsol):
-            rij=solvent_coords[j]-solvent_coords[i]; rij=rij-box_dim_arr*np.rint(rij/box_dim_arr); dsq=np.sum(rij**2)
-            if cutoff_sq is None or dsq<cutoff_sq: E+=calculate_lj_energy_pair_standard_c4(dsq,eps_ss,sigma_ss)
+    solvent_coords=np.ascontiguousarray(solvent_coords, dtype=np.float64)
+    idx_i, idx_j = _triu_pair_indices(Nsol, 1)
+    rij=solvent_coords[idx_j]-solvent_coords[idx_i]; rij-=box_dim_arr*np.rint(rij/box_dim_arr) # Minimum image
+    dsq=np.einsum('ij,ij->i', rij, rij)
+    if cutoff_sq is not None: dsq=dsq[dsq<cutoff_sq]
+    return _lj_energy_sum_c4(dsq, eps_ss, sigma_ss)
+
+def _lj_energy_sum_c4(r_sq_arr, epsilon, sigma): # Solvent-solvent LJ over an array of r^2, summed; overlaps score 1e10 like _solvent_pair_energy_nb
+    overlap=r_sq_arr<1e-12; sr6=((sigma**2)/np.where(overlap, 1.0, r_sq_arr))**3
+    return float(np.sum(np.where(overlap, 1e10, 4.0*epsilon*(sr6**2-sr6))))
+
+def _delta_solvent_move(solvent_coords, polymer_coords, p_idx, old_pos, new_pos, box_dim_arr,
+                        eps_ss, sigma_ss, lambda_val, eps_ms, sigma_ms, cutoff_sq=None):
+    # Energy change for moving solvent p_idx old_pos -> new_pos: only its O(Nsol + Npoly) interactions
+    delta_U = 0.0
+    for pos, sign in ((new_pos, 1.0), (old_pos, -1.0)):
+        rij=solvent_coords-pos; rij-=box_dim_arr*np.rint(rij/box_dim_arr); dsq=np.einsum('ij,ij->i', rij, rij)
+        dsq[p_idx]=np.inf # Exclude self-pair (contributes exactly 0)
+        if cutoff_sq is not None: dsq=dsq[dsq<cutoff_sq]
+        delta_U += sign * (_lj_energy_sum_c4(dsq, eps_ss, sigma_ss) +
+                           calculate_polymer_solvent_interaction_c4(polymer_coords, pos[None, :], lambda_val, eps_ms, sigma_ms))
+    return delta_U
+
+@njit(cache=True, fastmath=True)
+def _solvent_pair_energy_nb(solvent_coords, k, x, y, z, box_dim_arr, eps_ss, sigma_ss_sq, cutoff_sq):
+    # Minimum-image LJ between solvent k and a solvent placed at (x, y, z); cutoff_sq <= 0 means no cutoff
+    dx = solvent_coords[k, 0] - x; dx -= box_dim_arr[0] * np.rint(dx / box_dim_arr[0])
+    dy = solvent_coords[k, 1] - y; dy -= box_dim_arr[1] * np.rint(dy / box_dim_arr[1])
+    dz = solvent_coords[k, 2] - z; dz -= box_dim_arr[2] * np.rint(dz / box_dim_arr[2])
+    r_sq = dx*dx + dy*dy + dz*dz
+    if cutoff_sq > 0.0 and r_sq >= cutoff_sq: return 0.0
+    if r_sq < 1e-12: return 1e10
+    sr6 = (sigma_ss_sq / r_sq)**3
+    return 4.0 * eps_ss * (sr6 * sr6 - sr6)
+
+@njit(cache=True, fastmath=True)
+def _cell_index_nb(x, y, z, box_dim_arr, n_cells):
+    cx = int(math.floor(x / box_dim_arr[0] * n_cells)) % n_cells
+    cy = int(math.floor(y / box_dim_arr[1] * n_cells)) % n_cells
+    cz = int(math.floor(z / box_dim_arr[2] * n_cells)) % n_cells
+    return (cx * n_cells + cy) * n_cells + cz
+
+@njit(cache=True)
+def _build_cell_list_nb(solvent_coords, box_dim_arr, n_cells):
+    # Linked-list cells: cell_head[c] -> first particle, particle_next[i] -> next particle in the same cell (-1 ends)
+    num_solvent = solvent_coords.shape[0]
+    cell_head = np.full(n_cells**3, -1, dtype=np.int64); particle_next = np.full(num_solvent, -1, dtype=np.int64)
+    particle_cell = np.empty(num_solvent, dtype=np.int64)
+    for i in range(num_solvent):
+        c = _cell_index_nb(solvent_coords[i, 0], solvent_coords[i, 1], solvent_coords[i, 2], box_dim_arr, n_cells)
+        particle_cell[i] = c; particle_next[i] = cell_head[c]; cell_head[c] = i
+    return cell_head, particle_next, particle_cell
+
+@njit(cache=True, fastmath=True)
+def _solvent_particle_energy_nb(solvent_coords, polymer_coords, p_idx, x, y, z, box_dim_arr,
+                                eps_ss, sigma_ss, lambda_val, eps_ms, sigma_ms, cutoff_sq,
+                                cell_head, particle_next, n_cells):
+    # Energy of solvent p_idx placed at (x, y, z) with the other solvent (min. image) and the polymer (soft-core)
+    E = 0.0; sigma_ss_sq = sigma_ss * sigma_ss
+    if n_cells >= 3: # Only the 27 cells around (x, y, z) can hold partners within the cutoff
+        c = _cell_index_nb(x, y, z, box_dim_arr, n_cells)
+        cx = c // (n_cells * n_cells); cy = (c // n_cells) % n_cells; cz = c % n_cells
+        for ix in range(cx - 1, cx + 2):
+            for iy in range(cy - 1, cy + 2):
+                for iz in range(cz - 1, cz + 2):
+                    k = cell_head[((ix % n_cells) * n_cells + iy % n_cells) * n_cells + iz % n_cells]
+                    while k != -1:
+                        if k != p_idx: E += _solvent_pair_energy_nb(solvent_coords, k, x, y, z, box_dim_arr, eps_ss, sigma_ss_sq, cutoff_sq)
+                        k = particle_next[k]
+    else:
+        for k in range(solvent_coords.shape[0]):
+            if k != p_idx: E += _solvent_pair_energy_nb(solvent_coords, k, x, y, z, box_dim_arr, eps_ss, sigma_ss_sq, cutoff_sq)
+    if lambda_val < 1e-9: return E
+    sigma_ms_sq = sigma_ms * sigma_ms; soft_core = 0.5 * (1.0 - lambda_val)**2
+    for i in range(polymer_coords.shape[0]):
+        dx = polymer_coords[i, 0] - x; dy = polymer_coords[i, 1] - y; dz = polymer_coords[i, 2] - z
+        r_sq = dx*dx + dy*dy + dz*dz
+        if r_sq < 1e-12: E += 1e10; continue
+        denominator_base = soft_core + (sigma_ms_sq / r_sq)**3
+        if abs(denominator_base) < 1e-12: E += 1e10; continue
+        E += 4.0 * lambda_val * eps_ms * (1.0 / (denominator_base * denominator_base) - 1.0 / denominator_base)
     return E
 
+@njit(cache=True, fastmath=True)
+def _solvent_sweep_nb(solvent_coords, polymer_coords, box_dim_arr, eps_ss, sigma_ss, lambda_val, eps_ms, sigma_ms,
+                      beta, move_idx, displacements, log_uniforms, cutoff_sq, cell_head, particle_next, particle_cell, n_cells):
+    # Full solvent sweep (trial, delta-energy, Metropolis) on pre-drawn randoms; updates solvent_coords
+    # and, when n_cells >= 3, the cell list in place
+    n_accepted = 0; delta_U_total = 0.0
+    for m in range(move_idx.shape[0]):
+        p = move_idx[m]; ox = solvent_coords[p, 0]; oy = solvent_coords[p, 1]; oz = solvent_coords[p, 2]
+        nx = ox + displacements[m, 0]; nx -= box_dim_arr[0] * math.floor(nx / box_dim_arr[0])
+        ny = oy + displacements[m, 1]; ny -= box_dim_arr[1] * math.floor(ny / box_dim_arr[1])
+        nz = oz + displacements[m, 2]; nz -= box_dim_arr[2] * math.floor(nz / box_dim_arr[2])
+        delta_U = (_solvent_particle_energy_nb(solvent_coords, polymer_coords, p, nx, ny, nz, box_dim_arr, eps_ss, sigma_ss,
+                                               lambda_val, eps_ms, sigma_ms, cutoff_sq, cell_head, particle_next, n_cells) -
+                   _solvent_particle_energy_nb(solvent_coords, polymer_coords, p, ox, oy, oz, box_dim_arr, eps_ss, sigma_ss,
+                                               lambda_val, eps_ms, sigma_ms, cutoff_sq, cell_head, particle_next, n_cells))
+        if delta_U <= 0.0 or log_uniforms[m] < -beta * delta_U: # Metropolis in log space: no exp(), no overflow
+            solvent_coords[p, 0] = nx; solvent_coords[p, 1] = ny; solvent_coords[p, 2] = nz
+            n_accepted += 1; delta_U_total += delta_U
+            if n_cells >= 3:
+                new_c = _cell_index_nb(nx, ny, nz, box_dim_arr, n_cells); old_c = particle_cell[p]
+                if new_c != old_c: # Unlink p from its old cell, push onto the new one
+                    if cell_head[old_c] == p: cell_head[old_c] = particle_next[p]
+                    else:
+                        k = cell_head[old_c]
+                        while particle_next[k] != p: k = particle_next[k]
+                        particle_next[k] = particle_next[p]
+                    particle_next[p] = cell_head[new_c]; cell_head[new_c] = p; particle_cell[p] = new_c
+    return n_accepted, delta_U_total
+
+@functools.lru_cache(maxsize=4096)
+def _load_conf_cached(library_file_path, start_line_num, num_monomers):
+    # Polymer reselection keeps drawing from the same bins: parse each library entry once. The cached array is
+    # read-only (callers .copy() it); a failed load (None) is cached too, it would fail the same way again.
+    # Keyed by path only: Cell 3 and Cell 4 clear it on entry so a re-uploaded library is re-read
+    coords = load_specific_conformation_new_format(library_file_path, start_line_num, num_monomers)
+    if coords is not None: coords = np.ascontiguousarray(coords, dtype=np.float64); coords.setflags(write=False)
+    return coords
+
+# Per-attempt GEE log, stored column-wise (one array per field) by GEE_TMMC_Simulator_Cell4; each attempt fills its columns by name
+GEE_LOG_FIELDS = [("step", np.int64), ("from_j", np.int32), ("to_k", np.int32), ("U_j", np.float64), ("U_k", np.float64),
+                  ("delta_U", np.float64), ("eta_j", np.float64), ("eta_k", np.float64), ("eta_ratio", np.float64),
+                  ("boltzmann_factor", np.float64), ("log2_corr_applied", np.float64), ("p_acc_biased_walk", np.float64),
+                  ("accepted", np.bool_), ("factor_for_Ci", np.float64)]
+
 class GEE_TMMC_Simulator_Cell4:
     def __init__(self, initial_polymer_coords, initial_solvent_config, config_obj_from_sim, 
                  cv_bin_idx, binned_lib_entries_this_bin, lib_file_path, n_monomers_conf): # n_monomers_conf
-        self.polymer_coords = initial_polymer_coords 
-        self.initial_solvent_config_template = np.copy(initial_solvent_config) 
-        self.solvent_coords = np.copy(initial_solvent_config)
+        # Coordinates normalized once to C-contiguous float64 so the energy kernels never copy or re-type them
+        self.polymer_coords = np.ascontiguousarray(initial_polymer_coords, dtype=np.float64)
+        self.initial_solvent_config_template = np.array(initial_solvent_config, dtype=np.float64, order='C')
+        self.solvent_coords = np.array(initial_solvent_config, dtype=np.float64, order='C')
         self.sim_config = config_obj_from_sim 
         self.num_growth_stages = self.sim_config.num_growth_stages
         self.max_stage_idx = self.num_growth_stages - 1 
         self.lambda_values = np.linspace(0, 1, self.num_growth_stages)
-        self.beta = 1.0 / (KB * self.sim_config.target_temperature)
-        self.box_dim_arr = np.array([self.sim_config.box_side_length] * 3)
+        self.beta = 1.0 / (KB * self.sim_config.target_temperature); self.inv_beta = KB * self.sim_config.target_temperature
+        self._log2 = getattr(self.sim_config, 'LOG2', math.log(2.0))
+        self.box_dim_arr = np.asarray([self.sim_config.box_side_length] * 3, dtype=np.float64)
+        # Hot-loop parameters hoisted out of sim_config once (plain floats also keep Numba signatures stable)
+        self._eps_ss = float(self.sim_config.eps_ss); self._sigma_ss = float(self.sim_config.sigma_ss)
+        self._eps_ms = float(self.sim_config.eps_ms); self._sigma_ms = float(self.sim_config.sigma_ms)
+        self._max_displacement = float(self.sim_config.solvent_max_displacement)
+        self._num_solvent_particles = int(self.sim_config.num_solvent_particles)
+        seed = getattr(self.sim_config, 'random_seed', None) # Per-bin stream: (seed, bin) keeps bins independent yet reproducible
+        self.rng = np.random.default_rng(None if seed is None else [seed, cv_bin_idx]) # Every draw in the simulator comes from here
+        solvent_cutoff = getattr(self.sim_config, 'solvent_cutoff', None) # None: all solvent pairs interact
+        self.solvent_cutoff_sq = solvent_cutoff**2 if solvent_cutoff else None
+        self.n_cells_side = int(self.sim_config.box_side_length // solvent_cutoff) if solvent_cutoff else 0 # Cell list needs >= 3 cells of side >= cutoff per box edge
         self.current_growth_stage_idx = 0
         self.eta = np.ones(self.num_growth_stages)
-        self.collection_matrix_C_i_condensed = np.zeros((self.num_growth_stages, 3))
+        # Condensed C_i as plain nested lists: scalar += on a list is far cheaper than NumPy __setitem__;
+        # converted with np.array() wherever the whole matrix is needed (eta update, results)
+        self.collection_matrix_C_i_condensed = [[0.0, 0.0, 0.0] for _ in range(self.num_growth_stages)]
         self.visits_per_stage = np.zeros(self.num_growth_stages)
-        self.mc_cycle_history_log = []
+        self._reset_stage_history(0)
         self.total_solvent_moves_attempted = 0; self.total_solvent_moves_accepted = 0
         self.total_gee_moves_attempted = 0; self.total_gee_moves_accepted = 0
-        self.gee_attempt_details_log = []
+        self._reset_gee_log(0)
         self.cv_bin_index = cv_bin_idx
         self.binned_library_entries_for_this_bin = binned_lib_entries_this_bin
         self.library_file_path = lib_file_path
         self.num_monomers = n_monomers_conf # Use passed n_monomers
         self.current_polymer_lib_entry = None
+        # Last (stage_idx, U) evaluated; kept current across solvent sweeps via the tracked delta U and
+        # dropped whenever the coordinates change any other way (polymer reload)
+        self._energy_cache = None
 
     def _select_and_load_new_polymer(self):
-        if not self.binned_library_entries_for_this_bin: return False
-        selected_entry = random.choice(self.binned_library_entries_for_this_bin)
-        new_polymer_coords = load_specific_conformation_new_format(
-            self.library_file_path, selected_entry['start_line_num'], self.num_monomers)
+        if len(self.binned_library_entries_for_this_bin) == 0: return False
+        selected_entry = self.binned_library_entries_for_this_bin[self.rng.integers(len(self.binned_library_entries_for_this_bin))]
+        new_polymer_coords = _load_conf_cached(
+            self.library_file_path, int(selected_entry['start_line_num']), self.num_monomers)
         if new_polymer_coords is not None:
-            self.polymer_coords = new_polymer_coords; self.current_polymer_lib_entry = selected_entry
+            self.polymer_coords = new_polymer_coords.copy(); self.current_polymer_lib_entry = selected_entry
             print(f"    Switched to new polymer: Idx {selected_entry['original_index']} (Rg={selected_entry['cv']:.3f}) for CV Bin {self.cv_bin_index}")
             if len(self.initial_solvent_config_template) > 0: self.solvent_coords = np.copy(self.initial_solvent_config_template)
-            elif self.sim_config.num_solvent_particles > 0 : self.solvent_coords = np.random.rand(self.sim_config.num_solvent_particles, 3) * self.sim_config.box_side_length
-            else: self.solvent_coords = np.array([])
+            elif self.sim_config.num_solvent_particles > 0 : self.solvent_coords = self.rng.random((self.sim_config.num_solvent_particles, 3)) * self.sim_config.box_side_length
+            else: self.solvent_coords = np.empty((0, 3))
+            self._energy_cache = None
             return True
         print(f"    ERROR: Failed to load new polymer (Idx {selected_entry['original_index']}) for CV Bin {self.cv_bin_index}.")
         return False
 
+    def _reset_gee_log(self, capacity):
+        self.gee_attempt_details_log = {name: np.empty(capacity, dtype=dt) for name, dt in GEE_LOG_FIELDS}; self._gee_log_n = 0
+
+    def _reset_stage_history(self, capacity): # (elementary step, stage) samples as two parallel int arrays
+        self._mc_cycle_arr = np.empty(capacity, dtype=np.int64); self._stage_arr = np.empty(capacity, dtype=np.int32); self._log_n = 0
+
+    def _log_stage_history(self, step):
+        n = self._log_n
+        if n == len(self._mc_cycle_arr): # Full: double both arrays
+            self._mc_cycle_arr = np.concatenate((self._mc_cycle_arr, np.empty(max(n, 16), dtype=np.int64)))
+            self._stage_arr = np.concatenate((self._stage_arr, np.empty(max(n, 16), dtype=np.int32)))
+        self._mc_cycle_arr[n] = step; self._stage_arr[n] = self.current_growth_stage_idx; self._log_n = n + 1
+
+    def _gee_log_columns(self): # Filled part of each column (views)
+        return {name: col[:self._gee_log_n] for name, col in self.gee_attempt_details_log.items()}
+
     def get_total_system_energy(self, stage_idx):
-        if len(self.solvent_coords) == 0 and self.sim_config.num_solvent_particles == 0: return 0.0
+        if len(self.solvent_coords) == 0 and self._num_solvent_particles == 0: return 0.0
+        if self._energy_cache is not None and self._energy_cache[0] == stage_idx: return self._energy_cache[1]
         lambda_val = self.lambda_values[stage_idx]
-        U_ps = calculate_polymer_solvent_interaction_c4(self.polymer_coords, self.solvent_coords, lambda_val, self.sim_config.eps_ms, self.sim_config.sigma_ms)
-        U_ss = calculate_solvent_solvent_energy_c4(self.solvent_coords, self.sim_config.eps_ss, self.sim_config.sigma_ss, self.box_dim_arr)
+        U_ps = calculate_polymer_solvent_interaction_c4(self.polymer_coords, self.solvent_coords, lambda_val, self._eps_ms, self._sigma_ms)
+        U_ss = calculate_solvent_solvent_energy_c4(self.solvent_coords, self._eps_ss, self._sigma_ss, self.box_dim_arr, self.solvent_cutoff_sq)
+        self._energy_cache = (stage_idx, U_ps + U_ss)
         return U_ps + U_ss
         
+    def _advance_energy_cache(self, delta_U_sweep):
+        # Sweep moved solvent at the current stage: shift the cached U by the accepted deltas, else drop it.
+        # The next GEE attempt refreshes it exactly for the target stage, so rounding drift spans one block at most
+        if self._energy_cache is not None and self._energy_cache[0] == self.current_growth_stage_idx:
+            self._energy_cache = (self.current_growth_stage_idx, self._energy_cache[1] + delta_U_sweep)
+        else: self._energy_cache = None
+
     def run_solvent_mc_sweep(self):
         # ... (same as before)
         if len(self.solvent_coords) == 0: return 0.0
-        current_U_system_val = self.get_total_system_energy(self.current_growth_stage_idx)
+        lambda_val = self.lambda_values[self.current_growth_stage_idx]
         accepted_this_sweep = 0; num_particles_to_move = len(self.solvent_coords)
         self.total_solvent_moves_attempted += num_particles_to_move
-        for _ in range(num_particles_to_move):
-            p_idx = np.random.randint(num_particles_to_move); orig_coord = np.copy(self.solvent_coords[p_idx])
-            translate_solvent_molecule_pbc(self.solvent_coords, p_idx, self.sim_config.solvent_max_displacement, self.box_dim_arr)
-            new_U = self.get_total_system_energy(self.current_growth_stage_idx); delta_U = new_U - current_U_system_val
-            if random.random() < np.exp(-self.beta * delta_U): current_U_system_val = new_U; accepted_this_sweep += 1
-            else: self.solvent_coords[p_idx] = orig_coord
+        dmax = self._max_displacement # All randoms for the sweep in three vectorized draws
+        move_idx = self.rng.integers(0, num_particles_to_move, size=num_particles_to_move)
+        displacements = self.rng.uniform(-dmax, dmax, size=(num_particles_to_move, 3))
+        log_uniforms = np.log(np.maximum(self.rng.random(num_particles_to_move), np.finfo(np.float64).tiny)) # One vectorized log per sweep; floor keeps it finite
+        if NUMBA_AVAILABLE: # Whole sweep in one compiled call
+            if self.n_cells_side >= 3: cell_head, particle_next, particle_cell = _build_cell_list_nb(self.solvent_coords, self.box_dim_arr, self.n_cells_side)
+            else: cell_head = particle_next = particle_cell = np.empty(0, dtype=np.int64)
+            accepted_this_sweep, delta_U_sweep = _solvent_sweep_nb(
+                self.solvent_coords, self.polymer_coords, self.box_dim_arr,
+                self._eps_ss, self._sigma_ss, lambda_val, self._eps_ms, self._sigma_ms,
+                self.beta, move_idx, displacements, log_uniforms, self.solvent_cutoff_sq or 0.0,
+                cell_head, particle_next, particle_cell, self.n_cells_side)
+            self._advance_energy_cache(delta_U_sweep)
+            self.total_solvent_moves_accepted += accepted_this_sweep
+            return accepted_this_sweep / num_particles_to_move
+        delta_U_sweep = 0.0
+        for m in range(num_particles_to_move):
+            p_idx = move_idx[m]; orig_coord = self.solvent_coords[p_idx]
+            new_coord = orig_coord + displacements[m]; new_coord -= self.box_dim_arr * np.floor(new_coord / self.box_dim_arr) # Wrap into box
+            delta_U = _delta_solvent_move(self.solvent_coords, self.polymer_coords, p_idx, orig_coord, new_coord, self.box_dim_arr,
+                                          self._eps_ss, self._sigma_ss, lambda_val, self._eps_ms, self._sigma_ms, self.solvent_cutoff_sq)
+            if delta_U <= 0.0 or log_uniforms[m] < -self.beta * delta_U: self.solvent_coords[p_idx] = new_coord; accepted_this_sweep += 1; delta_U_sweep += delta_U
+        self._advance_energy_cache(delta_U_sweep)
         self.total_solvent_moves_accepted += accepted_this_sweep
         return accepted_this_sweep / num_particles_to_move
 
@@ -350,49 +685,56 @@ class GEE_TMMC_Simulator_Cell4:
         else: 
             if j > 0: k_target_for_biased_walk = j - 1
         factor_for_Ci_update = 0.0; log2_correction = 0.0
+        U_k = self.get_total_system_energy(k_target_for_biased_walk) if k_target_for_biased_walk != -1 else U_j # One evaluation per stage per attempt
         if k_target_for_biased_walk != -1:
-            k_ci = k_target_for_biased_walk; U_k_ci = self.get_total_system_energy(k_ci); delta_U_ci = U_k_ci - U_j                   
+            k_ci = k_target_for_biased_walk; delta_U_ci = U_k - U_j
             log_boltzmann_for_Ci = -self.beta * delta_U_ci
-            if (j == 0 and k_ci == 1) or (j == self.max_stage_idx - 1 and k_ci == self.max_stage_idx): log2_correction = np.log(2.0)
-            elif (j == 1 and k_ci == 0) or (j == self.max_stage_idx and k_ci == self.max_stage_idx - 1): log2_correction = -np.log(2.0)
+            if (j == 0 and k_ci == 1) or (j == self.max_stage_idx - 1 and k_ci == self.max_stage_idx): log2_correction = self._log2
+            elif (j == 1 and k_ci == 0) or (j == self.max_stage_idx and k_ci == self.max_stage_idx - 1): log2_correction = -self._log2
             log_factor_for_Ci = log_boltzmann_for_Ci + log2_correction
-            factor_for_Ci_update = np.exp(log_factor_for_Ci) if log_factor_for_Ci < 0 else 1.0
+            factor_for_Ci_update = math.exp(log_factor_for_Ci) if log_factor_for_Ci < 0 else 1.0
             factor_for_Ci_update = min(1.0, factor_for_Ci_update)
-            if k_ci > j: self.collection_matrix_C_i_condensed[j, 2] += factor_for_Ci_update
-            else: self.collection_matrix_C_i_condensed[j, 0] += factor_for_Ci_update
-            self.collection_matrix_C_i_condensed[j, 1] += (1.0 - factor_for_Ci_update)
-        else: self.collection_matrix_C_i_condensed[j, 1] += 1.0
-        p_acc_biased_walk = 0.0; log_eta_ratio_walk = 0.0; eta_ratio_val_walk = 1.0; log_boltzmann_walk = 0.0; delta_U_walk = 0.0; k_walk_actual_target = k_target_for_biased_walk
+            C_row_j = self.collection_matrix_C_i_condensed[j]
+            if k_ci > j: C_row_j[2] += factor_for_Ci_update
+            else: C_row_j[0] += factor_for_Ci_update
+            C_row_j[1] += (1.0 - factor_for_Ci_update)
+        else: self.collection_matrix_C_i_condensed[j][1] += 1.0
+        p_acc_biased_for_walk = 0.0; log_eta_ratio_walk = 0.0; eta_ratio_val_walk = 1.0; log_boltzmann_walk = 0.0; delta_U_walk = 0.0; k_walk_actual_target = k_target_for_biased_walk
         if k_target_for_biased_walk != -1:
-            delta_U_walk = self.get_total_system_energy(k_walk_actual_target) - U_j; log_boltzmann_walk = -self.beta * delta_U_walk
+            delta_U_walk = U_k - U_j; log_boltzmann_walk = -self.beta * delta_U_walk
             if abs(self.eta[j]) > 1e-12:
                 eta_ratio_val_walk = self.eta[k_walk_actual_target] / self.eta[j]
-                if eta_ratio_val_walk > 1e-12: log_eta_ratio_walk = np.log(eta_ratio_val_walk)
+                if eta_ratio_val_walk > 1e-12: log_eta_ratio_walk = math.log(eta_ratio_val_walk)
                 else: log_eta_ratio_walk = -float('inf') 
             elif delta_U_walk * self.beta > 0 : log_eta_ratio_walk = -float('inf')
             log_p_acc_unbounded_walk = log_eta_ratio_walk + log_boltzmann_walk + log2_correction # Use same log2_correction
-            p_acc_biased_for_walk = np.exp(log_p_acc_unbounded_walk) if log_p_acc_unbounded_walk < 0 else 1.0
-        accepted = random.random() < p_acc_biased_for_walk
-        self.gee_attempt_details_log.append({"step":current_total_elementary_steps,"from_j":j,"to_k":k_walk_actual_target,"U_j":U_j,"U_k":self.get_total_system_energy(k_walk_actual_target) if k_walk_actual_target!=-1 else U_j,"delta_U":delta_U_walk,"eta_j":self.eta[j],"eta_k":self.eta[k_walk_actual_target if k_walk_actual_target!=-1 else j],"eta_ratio":eta_ratio_val_walk,"boltzmann_factor":np.exp(log_boltzmann_walk),"log2_corr_applied":log2_correction,"p_acc_biased_walk":p_acc_biased_for_walk,"accepted":accepted,"factor_for_Ci":factor_for_Ci_update})
+            p_acc_biased_for_walk = math.exp(log_p_acc_unbounded_walk) if log_p_acc_unbounded_walk < 0 else 1.0
+        accepted = self.rng.random() < p_acc_biased_for_walk
+        n = self._gee_log_n; log = self.gee_attempt_details_log
+        if n == len(log["step"]): # Full (attempts beyond the planned count): double every column
+            for name in log: log[name] = np.concatenate((log[name], np.empty(max(n, 16), dtype=log[name].dtype)))
+        log["step"][n] = current_total_elementary_steps; log["from_j"][n] = j; log["to_k"][n] = k_walk_actual_target
+        log["U_j"][n] = U_j; log["U_k"][n] = U_k; log["delta_U"][n] = delta_U_walk
+        log["eta_j"][n] = self.eta[j]; log["eta_k"][n] = self.eta[k_walk_actual_target if k_walk_actual_target!=-1 else j]; log["eta_ratio"][n] = eta_ratio_val_walk
+        log["boltzmann_factor"][n] = math.exp(log_boltzmann_walk) if log_boltzmann_walk < 709.0 else float('inf')
+        log["log2_corr_applied"][n] = log2_correction; log["p_acc_biased_walk"][n] = p_acc_biased_for_walk
+        log["accepted"][n] = accepted; log["factor_for_Ci"][n] = factor_for_Ci_update
+        self._gee_log_n = n + 1
         if accepted: self.current_growth_stage_idx=k_walk_actual_target; self.total_gee_moves_accepted+=1; return True
         return False
 
     def update_eta_biasing_factors(self):
         # ... (Same robust eta update logic as before) ...
-        temp_F = np.zeros(self.num_growth_stages)
-        for j_stage in range(self.num_growth_stages - 1):
-            N_j = np.sum(self.collection_matrix_C_i_condensed[j_stage, :])
-            N_jplus1 = np.sum(self.collection_matrix_C_i_condensed[j_stage+1, :])
-            P_j_to_jplus1 = self.collection_matrix_C_i_condensed[j_stage, 2] / (N_j + 1e-12)
-            P_jplus1_to_j = self.collection_matrix_C_i_condensed[j_stage+1, 0] / (N_jplus1 + 1e-12)
-            delta_F_step = 0.0
-            if P_jplus1_to_j < 1e-12: delta_F_step = 0.0 if P_j_to_jplus1 < 1e-12 else -20.0 
-            elif P_j_to_jplus1 < 1e-12: delta_F_step = 20.0
-            else:
-                ratio = P_j_to_jplus1 / P_jplus1_to_j
-                if ratio > 1e-9 : delta_F_step = -(1.0/self.beta) * np.log(ratio)
-                elif ratio < -1e-9: delta_F_step = 20.0
-            temp_F[j_stage+1] = temp_F[j_stage] + delta_F_step
+        C = np.array(self.collection_matrix_C_i_condensed); N_j = np.sum(C, axis=1)
+        P_j_to_jplus1 = C[:-1, 2] / (N_j[:-1] + 1e-12); P_jplus1_to_j = C[1:, 0] / (N_j[1:] + 1e-12)
+        with np.errstate(divide='ignore', invalid='ignore'): # Zero-probability lanes are masked out below
+            ratio = P_j_to_jplus1 / P_jplus1_to_j
+            log_ratio = np.log(np.where(ratio > 1e-9, ratio, 1.0))
+        # Same tiers as the scalar branches: no backward flow, no forward flow, then the log-ratio itself
+        delta_F_steps = np.where(P_jplus1_to_j < 1e-12, np.where(P_j_to_jplus1 < 1e-12, 0.0, -20.0),
+                        np.where(P_j_to_jplus1 < 1e-12, 20.0,
+                        np.where(ratio > 1e-9, -self.inv_beta * log_ratio, np.where(ratio < -1e-9, 20.0, 0.0))))
+        temp_F = np.concatenate(([0.0], np.cumsum(delta_F_steps)))
         if np.any(np.isfinite(temp_F)):
             valid_F_elements = temp_F[np.isfinite(temp_F)]
             if len(valid_F_elements) == 0: self.eta = np.ones(self.num_growth_stages); return
@@ -417,7 +759,8 @@ class GEE_TMMC_Simulator_Cell4:
                                   plot_log_freq, verbose_print_freq_val, 
                                   solvent_sweeps_per_gee_attempt_val):
         # ... (Structure with equilibration/production loops and dynamic polymer selection logic is same) ...
-        self.mc_cycle_history_log = []; self.gee_attempt_details_log = []
+        self._reset_gee_log(equilibration_cycles + production_cycles) # One GEE attempt per outer block
+        self._reset_stage_history((equilibration_cycles + production_cycles) * max(1, solvent_sweeps_per_gee_attempt_val) // max(1, plot_log_freq))
         self.total_solvent_moves_attempted = 0; self.total_solvent_moves_accepted = 0
         self.total_gee_moves_attempted = 0; self.total_gee_moves_accepted = 0
         current_total_elementary_steps = 0; growth_phase = True
@@ -425,13 +768,13 @@ class GEE_TMMC_Simulator_Cell4:
         num_polymer_selections = 0
         if self.current_polymer_lib_entry: num_polymer_selections = 1 # Count the initial one
         else: # If not set by main block, select one now
-            if not self._select_and_load_new_polymer(): print(f"CRITICAL ERROR: Could not load initial polymer for CV Bin {self.cv_bin_index}"); return None,None,None,None,0,0,0,0,[]
+            if not self._select_and_load_new_polymer(): print(f"CRITICAL ERROR: Could not load initial polymer for CV Bin {self.cv_bin_index}"); return None,None,None,None,0,0,0,0,self._gee_log_columns()
 
         print(f"  Starting Equilibration Phase ({equilibration_cycles} outer GEE blocks)...")
         for outer_cycle_eq in range(equilibration_cycles):
             for _ in range(sweeps_per_block):
                 self.run_solvent_mc_sweep(); current_total_elementary_steps += 1
-                if current_total_elementary_steps % plot_log_freq == 0: self.mc_cycle_history_log.append((current_total_elementary_steps, self.current_growth_stage_idx))
+                if current_total_elementary_steps % plot_log_freq == 0: self._log_stage_history(current_total_elementary_steps)
                 if current_total_elementary_steps % verbose_print_freq_val == 0:
                     energy = self.get_total_system_energy(self.current_growth_stage_idx)
                     print(f"    Equil Step {current_total_elementary_steps:8d} | Blk {outer_cycle_eq:6d} | St: {self.current_growth_stage_idx:2d} | E: {energy:10.4f} | Ph: {'Gr' if growth_phase else 'De'}")
@@ -451,7 +794,7 @@ class GEE_TMMC_Simulator_Cell4:
         for outer_cycle_prod in range(production_cycles):
             for _ in range(sweeps_per_block):
                 self.run_solvent_mc_sweep(); current_total_elementary_steps +=1
-                if current_total_elementary_steps % plot_log_freq == 0: self.mc_cycle_history_log.append((current_total_elementary_steps, self.current_growth_stage_idx))
+                if current_total_elementary_steps % plot_log_freq == 0: self._log_stage_history(current_total_elementary_steps)
                 if current_total_elementary_steps % verbose_print_freq_val == 0:
                     energy = self.get_total_system_energy(self.current_growth_stage_idx)
                     print(f"    Prod. Step {current_total_elementary_steps:8d} | Blk {outer_cycle_prod:6d} | St: {self.current_growth_stage_idx:2d} | E: {energy:10.4f} | Ph: {'Gr' if growth_phase else 'De'}")
@@ -468,51 +811,55 @@ class GEE_TMMC_Simulator_Cell4:
             if outer_cycle_prod > 0 and outer_cycle_prod % eta_upd_outer_freq == 0 : self.update_eta_biasing_factors()
         print(f"  Prod Complete. Stage: {self.current_growth_stage_idx}, Elm. Steps: {current_total_elementary_steps}")
         print(f"  Total polymer conformations sampled for this CV bin: {num_polymer_selections}")
-        mc_cycles_out = [item[0] for item in self.mc_cycle_history_log]
-        stage_indices_out = [item[1] for item in self.mc_cycle_history_log]
-        return (self.collection_matrix_C_i_condensed, self.visits_per_stage,
+        mc_cycles_out = self._mc_cycle_arr[:self._log_n]; stage_indices_out = self._stage_arr[:self._log_n]
+        return (np.array(self.collection_matrix_C_i_condensed), self.visits_per_stage,
                 mc_cycles_out, stage_indices_out,
                 self.total_solvent_moves_attempted, self.total_solvent_moves_accepted,
                 self.total_gee_moves_attempted, self.total_gee_moves_accepted,
-                self.gee_attempt_details_log)
+                self._gee_log_columns())
 
 # --- FreeEnergyCalculator_Cell4 Class (Definition as in previous complete Cell 4) ---
 # ... (This class remains unchanged) ...
+@njit(cache=True, fastmath=True)
+def _f_diffs_nb(C, inv_beta):
+    # Compiled calculate_F_i_j_minus_F_i_1 for (S, 3) C: same floored log-ratio, +-20 clip and no-flow mask, one pass
+    S = C.shape[0]; F = np.zeros(S)
+    for j in range(S - 1):
+        p_fwd = C[j, 2] / (C[j, 0] + C[j, 1] + C[j, 2] + 1e-12); p_bwd = C[j+1, 0] / (C[j+1, 0] + C[j+1, 1] + C[j+1, 2] + 1e-12)
+        delta = 0.0
+        if p_fwd >= 1e-12 or p_bwd >= 1e-12:
+            delta = -inv_beta * (math.log(max(p_fwd, 1e-300)) - math.log(max(p_bwd, 1e-300)))
+            delta = min(20.0, max(-20.0, delta))
+        F[j+1] = F[j] + delta
+    return F
+
 class FreeEnergyCalculator_Cell4:
     def __init__(self, config_obj_from_sim): 
         self.sim_config = config_obj_from_sim
         self.beta = 1.0 / (KB * self.sim_config.target_temperature)
+        self.inv_beta = KB * self.sim_config.target_temperature # kT: log terms scale by a multiply, not a divide
     def calculate_F_i_j_minus_F_i_1(self, C_i_condensed_np_arr):
-        num_stages = self.sim_config.num_growth_stages; F_diffs = np.zeros(num_stages)
-        for j in range(num_stages - 1):
-            N_j = np.sum(C_i_condensed_np_arr[j, :]); N_jplus1 = np.sum(C_i_condensed_np_arr[j+1, :])
-            P_j_to_jplus1 = C_i_condensed_np_arr[j, 2] / (N_j + 1e-12)
-            P_jplus1_to_j = C_i_condensed_np_arr[j+1, 0] / (N_jplus1 + 1e-12)
-            delta_F_step = 0.0
-            if P_jplus1_to_j < 1e-12: delta_F_step = 0.0 if P_j_to_jplus1 < 1e-12 else -20.0 
-            elif P_j_to_jplus1 < 1e-12: delta_F_step = 20.0
-            else:
-                ratio = P_j_to_jplus1 / P_jplus1_to_j
-                if ratio > 1e-9 : delta_F_step = -(1.0/self.beta) * np.log(ratio)
-                elif ratio < -1e-9: delta_F_step = 20.0
-            F_diffs[j+1] = F_diffs[j] + delta_F_step
-        return F_diffs
-    def calculate_delta_F_i1_initial(self, ni_counts_per_bin_dict, n1_count_ref_bin):
-        beta_eff = 1.0 / (KB * self.sim_config.target_temperature)
+        num_stages = self.sim_config.num_growth_stages
+        C = np.ascontiguousarray(C_i_condensed_np_arr, dtype=np.float64)[:num_stages] # C-order float64 (leading-row slice stays contiguous)
+        if NUMBA_AVAILABLE: return _f_diffs_nb(C, self.inv_beta) # Few stages: one compiled loop beats NumPy temporaries
+        N = np.sum(C, axis=1)
+        P_j_to_jplus1 = C[:-1, 2] / (N[:-1] + 1e-12); P_jplus1_to_j = C[1:, 0] / (N[1:] + 1e-12)
+        # Branchless: -kT * log(P_fwd / P_bwd) as a difference of logs (zero probabilities floored), clipped to +-20;
+        # a one-sided zero lands on the clip, and pairs with no flow either way are zeroed by the mask
+        delta_F_steps = np.log(np.maximum(P_j_to_jplus1, 1e-300)) - np.log(np.maximum(P_jplus1_to_j, 1e-300))
+        delta_F_steps *= -self.inv_beta; np.clip(delta_F_steps, -20.0, 20.0, out=delta_F_steps)
+        delta_F_steps = np.where((P_j_to_jplus1 >= 1e-12) | (P_jplus1_to_j >= 1e-12), delta_F_steps, 0.0) # Not a multiply: that leaves -0.0
+        return np.concatenate(([0.0], np.cumsum(delta_F_steps)))
+    def calculate_delta_F_i1_initial(self, ni_counts, n1_count_ref_bin):
+        # Per-bin array (index = CV bin); inf where the bin or the reference bin is empty
         if abs(self.sim_config.library_temperature - self.sim_config.target_temperature) > 1e-3: print(f"Warning: Library/Target temps differ. Eq. 12 uses target T.")
-        delta_F_i1_dict = {}
-        for bin_idx, ni_count in ni_counts_per_bin_dict.items():
-            if ni_count == 0 or n1_count_ref_bin == 0: delta_F_i1_dict[bin_idx] = float('inf')
-            else: delta_F_i1_dict[bin_idx] = -(1.0/beta_eff) * np.log(float(ni_count) / float(n1_count_ref_bin))
-        return delta_F_i1_dict
-    def combine_free_energies(self, F_ij_minus_F_i1_all_bins_dict, delta_F_i1_initial_dict):
-        final_delta_F_profiles = {}
-        for cv_bin_idx, f_diffs_profile_np_list in F_ij_minus_F_i1_all_bins_dict.items():
-            f_diffs_profile_np = np.array(f_diffs_profile_np_list)
-            delta_Fi1 = delta_F_i1_initial_dict.get(cv_bin_idx, float('inf'))
-            if np.isinf(delta_Fi1): final_delta_F_profiles[cv_bin_idx] = np.full_like(f_diffs_profile_np, float('inf'))
-            else: final_delta_F_profiles[cv_bin_idx] = f_diffs_profile_np + delta_Fi1
-        return final_delta_F_profiles
+        ni = np.asarray(ni_counts, dtype=np.float64); delta_F_i1 = np.full(ni.shape, np.inf)
+        if n1_count_ref_bin > 0: mask = ni > 0; delta_F_i1[mask] = -self.inv_beta * np.log(ni[mask] / float(n1_count_ref_bin))
+        return delta_F_i1
+    def combine_free_energies(self, F_mat, delta_F_i1_initial):
+        # (num_bins, num_stages) profiles + per-bin delta F_i1 in one broadcast; rows with an undefined (inf) delta are all inf
+        F_mat = np.ascontiguousarray(F_mat, dtype=np.float64); d = np.asarray(delta_F_i1_initial, dtype=np.float64)[:, None]
+        return np.where(np.isinf(d), np.inf, F_mat + d)
 
 # Custom JSON encoder
 class NpEncoder(json.JSONEncoder):
@@ -522,10 +869,42 @@ class NpEncoder(json.JSONEncoder):
         if isinstance(obj, np.ndarray): return obj.tolist()
         return super(NpEncoder, self).default(obj)
 
+def _has_non_finite(value): # inf/nan anywhere in a (nested) summary field
+    if isinstance(value, float): return not math.isfinite(value)
+    if isinstance(value, np.ndarray): return value.dtype.kind in 'fc' and not np.isfinite(value).all()
+    if isinstance(value, np.floating): return not np.isfinite(value)
+    if isinstance(value, dict): return any(_has_non_finite(v) for v in value.values())
+    if isinstance(value, (list, tuple)): return any(_has_non_finite(v) for v in value)
+    return False
+
+def write_json_summary(path, fields):
+    # Streams a top-level JSON object: each (key, value) from `fields` is encoded and written before the next one is
+    # produced, so only one field is materialized at a time. Goes through a temp file so a failure leaves no truncated summary.
+    # orjson when available (arrays encoded in C, int dict keys allowed); stdlib json + NpEncoder otherwise.
+    # orjson turns inf/nan into null, so a field holding any (e.g. empty-bin inf in the FE profiles) is re-encoded with
+    # json: the file always carries Infinity/NaN, whichever backend is installed
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(b'{'); sep = b'\n'
+            for key, value in fields:
+                if ORJSON_AVAILABLE: # NpEncoder.default only sees what orjson cannot do natively (e.g. non-contiguous arrays)
+                    blob = orjson.dumps(value, default=NpEncoder().default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+                    if b'null' in blob and _has_non_finite(value): blob = None # Only scanned when a null shows up
+                else: blob = None
+                if blob is None: blob = json.dumps(value, indent=2, cls=NpEncoder).encode()
+                f.write(sep + b'  ' + json.dumps(str(key)).encode() + b': ' + blob.replace(b'\n', b'\n  ')); sep = b',\n'
+            f.write(b'\n}' if sep != b'\n' else b'}')
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+
 # --- Main Execution Block for Cell 4 ---
 def run_simulation_main_logic(config_obj): # Encapsulate main logic
     global sim_config # Make sure sim_config is the one from Cell 2
     sim_config = config_obj
+    _load_conf_cached.cache_clear() # Never reuse coordinates parsed from an earlier copy of the library
 
     print(f"TMMC simulations: {sim_config.num_cv_bins} CV bins. Equil: {sim_config.mc_equilibration_cycles} outer blocks, Prod: {sim_config.mc_production_cycles} outer blocks.")
     print(f"Each outer block: {sim_config.solvent_sweeps_per_gee_attempt} solvent sweeps then 1 GEE attempt.")
@@ -533,37 +912,36 @@ def run_simulation_main_logic(config_obj): # Encapsulate main logic
     print(f"Collection matrix C_i and Biased Walk will include log(2.0) boundary factors for ALL boundaries (0<=>1 and max-1<=>max).")
     
     processed_library_path = os.path.join(sim_config.output_dir, "library_processed_index.txt")
-    library_index_data = []; all_cv_values_from_index = []
     try:
-        with open(processed_library_path, 'r') as f:
-            for line in f:
-                if line.startswith("#"): continue; parts = line.split()
-                if len(parts) < 4: continue
-                library_index_data.append({"original_index": int(parts[0]), "start_line_num": int(parts[1]), "cv": float(parts[2]), "energy": float(parts[3])})
-                all_cv_values_from_index.append(float(parts[2]))
-        if not library_index_data: raise FileNotFoundError("Processed library index is empty.")
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", UserWarning) # Header-only file: loadtxt warns, emptiness is reported below
+            library_index_data = np.loadtxt(processed_library_path, comments="#", dtype=LIBRARY_INDEX_DTYPE, ndmin=1)
+        if len(library_index_data) == 0: raise FileNotFoundError("Processed library index is empty.")
         print(f"Loaded {len(library_index_data)} entries from '{processed_library_path}'.")
-    except FileNotFoundError as e: print(f"FATAL ERROR: {e}. Run Cell 3."); raise SystemExit(f"Exiting: {e}")
+    except (FileNotFoundError, ValueError) as e: print(f"FATAL ERROR: {e}. Run Cell 3."); raise SystemExit(f"Exiting: {e}")
+    all_cv_values_from_index = library_index_data["cv"] # Column view; rows are records indexable like the old dicts
 
     # Binning logic
-    if sim_config.cv_min is None and all_cv_values_from_index: sim_config.cv_min = min(all_cv_values_from_index)
+    if sim_config.cv_min is None and len(all_cv_values_from_index): sim_config.cv_min = float(all_cv_values_from_index.min())
     elif sim_config.cv_min is None: sim_config.cv_min = 0.0
-    if sim_config.cv_max is None and all_cv_values_from_index: sim_config.cv_max = max(all_cv_values_from_index)
+    if sim_config.cv_max is None and len(all_cv_values_from_index): sim_config.cv_max = float(all_cv_values_from_index.max())
     elif sim_config.cv_max is None: sim_config.cv_max = sim_config.cv_min
     if abs(sim_config.cv_max - sim_config.cv_min) < 1e-9: sim_config.cv_bin_width = 0.0
     elif sim_config.num_cv_bins > 0 : sim_config.cv_bin_width = (sim_config.cv_max - sim_config.cv_min) / sim_config.num_cv_bins
     else: sim_config.cv_bin_width = 0.0; print("Warning: num_cv_bins is 0 or negative.")
-    print(f"Using CV range for binning: {sim_config.cv_min:.4f} to {sim_config.cv_max:.4f}, width: {sim_config.cv_bin_width:.4f if sim_config.cv_bin_width else 'N/A'}")
-    binned_library_indices = [[] for _ in range(sim_config.num_cv_bins)]; ni_counts = np.zeros(sim_config.num_cv_bins, dtype=int)
-    for entry in library_index_data:
-        cv_val = entry["cv"]; bin_idx = 0
-        if sim_config.cv_bin_width > 1e-9 : bin_idx = math.floor((cv_val - sim_config.cv_min) / sim_config.cv_bin_width)
-        elif not (sim_config.cv_min -1e-9 <= cv_val <= sim_config.cv_max + 1e-9) : continue
-        bin_idx = max(0, min(sim_config.num_cv_bins - 1, bin_idx))
-        binned_library_indices[bin_idx].append(entry); ni_counts[bin_idx] += 1
+    print(f"Using CV range for binning: {sim_config.cv_min:.4f} to {sim_config.cv_max:.4f}, width: {f'{sim_config.cv_bin_width:.4f}' if sim_config.cv_bin_width else 'N/A'}")
+    bin_offsets = load_library_bin_offsets(sim_config, len(library_index_data))
+    if bin_offsets is not None: order, offsets = bin_offsets; print(f"Using precomputed CV bin offsets from '{LIBRARY_BIN_OFFSETS_FNAME}'.")
+    else: _, order, offsets = library_cv_bins(library_index_data["cv"], sim_config) # Same rule Cell 3 used for the offsets file
+    ni_counts = np.diff(offsets).astype(int)
+    # Bin b holds the records order[offsets[b]:offsets[b+1]] of the index, as a structured array of its own
+    binned_library_indices = [library_index_data[order[offsets[b]:offsets[b+1]]] for b in range(sim_config.num_cv_bins)]
     print(f"Conformations per CV bin (ni_counts): {ni_counts}")
 
-    all_F_ij_minus_F_i1 = {}; all_C_i_condensed_dict = {}; all_visits_dict = {}
+    # Per-bin results preallocated over the dense bin range; simulated_bins marks the rows actually filled
+    num_bins, num_stages = sim_config.num_cv_bins, sim_config.num_growth_stages
+    all_F_ij_minus_F_i1 = np.full((num_bins, num_stages), np.nan); all_C_i_condensed = np.zeros((num_bins, num_stages, 3))
+    all_visits = np.zeros((num_bins, num_stages), dtype=np.int64); simulated_bins = np.zeros(num_bins, dtype=bool)
     all_mc_cycle_histories_dict = {}; all_stage_histories_dict = {}
     all_gee_attempt_details_log_dict = {}
     cumulative_solvent_attempted = 0; cumulative_solvent_accepted = 0
@@ -577,19 +955,21 @@ def run_simulation_main_logic(config_obj): # Encapsulate main logic
         if len(non_empty_bins) > 1 : plot_bins_indices.append(non_empty_bins[-1])
         plot_bins_indices = sorted(list(set(plot_bins_indices)))
     print(f"Will plot detailed MC history & GEE logs for CV bins: {plot_bins_indices}")
+    rng = np.random.default_rng(getattr(sim_config, 'random_seed', None)) # Initial polymer / solvent draws; simulators seed their own per-bin streams
+    fe_calculator = FreeEnergyCalculator_Cell4(sim_config) # One calculator for per-bin profiles and the final combination
 
     for i_cv_bin in range(sim_config.num_cv_bins):
         print(f"\n--- Processing CV Bin {i_cv_bin} ---")
         if ni_counts[i_cv_bin] == 0: print(f"CV Bin {i_cv_bin} is empty. Skipping."); continue
         processed_bins_count +=1
-        first_lib_entry_for_bin = random.choice(binned_library_indices[i_cv_bin])
-        initial_polymer_coords = load_specific_conformation_new_format(
-            sim_config.conformation_library_file, first_lib_entry_for_bin['start_line_num'], sim_config.num_monomers)
+        first_lib_entry_for_bin = binned_library_indices[i_cv_bin][rng.integers(ni_counts[i_cv_bin])]
+        initial_polymer_coords = _load_conf_cached(
+            sim_config.conformation_library_file, int(first_lib_entry_for_bin['start_line_num']), sim_config.num_monomers)
         if initial_polymer_coords is None: print(f"  ERROR: Could not load initial polymer for bin {i_cv_bin}. Skipping."); continue
         
         initial_solvent_coords_for_sim = np.array([])
         if sim_config.num_solvent_particles > 0:
-            initial_solvent_coords_for_sim = np.random.rand(sim_config.num_solvent_particles, 3) * sim_config.box_side_length
+            initial_solvent_coords_for_sim = rng.random((sim_config.num_solvent_particles, 3)) * sim_config.box_side_length
             if sim_config.initial_solvent_box_file and os.path.exists(sim_config.initial_solvent_box_file):
                 try:
                     loaded_solvent = np.loadtxt(sim_config.initial_solvent_box_file)
@@ -600,7 +980,7 @@ def run_simulation_main_logic(config_obj): # Encapsulate main logic
         else: print("  Running with NO SOLVENT MOLECULES.")
 
         gee_simulator = GEE_TMMC_Simulator_Cell4(
-            initial_polymer_coords, initial_solvent_coords_for_sim, sim_config,
+            initial_polymer_coords.copy(), initial_solvent_coords_for_sim, sim_config,
             i_cv_bin, binned_library_indices[i_cv_bin], 
             sim_config.conformation_library_file, sim_config.num_monomers)
         gee_simulator.current_polymer_lib_entry = first_lib_entry_for_bin
@@ -614,15 +994,13 @@ def run_simulation_main_logic(config_obj): # Encapsulate main logic
             continue
         C_i_cond, visits_i, mc_hist, stage_hist, solv_att, solv_acc, gee_att, gee_acc, gee_details = sim_results
         
-        all_C_i_condensed_dict[i_cv_bin] = C_i_cond.tolist()
-        all_visits_dict[i_cv_bin] = visits_i.tolist()
+        all_C_i_condensed[i_cv_bin] = C_i_cond; all_visits[i_cv_bin] = visits_i; simulated_bins[i_cv_bin] = True
         cumulative_solvent_attempted += solv_att; cumulative_solvent_accepted += solv_acc
         cumulative_gee_attempted += gee_att; cumulative_gee_accepted += gee_acc
         if i_cv_bin in plot_bins_indices:
             all_mc_cycle_histories_dict[i_cv_bin] = mc_hist
             all_stage_histories_dict[i_cv_bin] = stage_hist
             all_gee_attempt_details_log_dict[i_cv_bin] = gee_details
-        fe_calculator = FreeEnergyCalculator_Cell4(sim_config)
         F_diffs_for_bin = fe_calculator.calculate_F_i_j_minus_F_i_1(C_i_cond)
         all_F_ij_minus_F_i1[i_cv_bin] = F_diffs_for_bin
         print(f"  Bin {i_cv_bin}: F_i(target) - F_i(library_state) = {F_diffs_for_bin[-1]:.4f} (kBT_target units)")
@@ -634,30 +1012,28 @@ def run_simulation_main_logic(config_obj): # Encapsulate main logic
         plt.figure(figsize=(10,6)); 
         for i_p, mc_h in all_mc_cycle_histories_dict.items():
             st_h = all_stage_histories_dict[i_p]
-            if mc_h and st_h: plt.plot(mc_h,st_h,marker='.',ls='-',ms=1,alpha=0.7,label=f'CV Bin {i_p}')
+            if len(mc_h) and len(st_h): plt.plot(mc_h,st_h,marker='.',ls='-',ms=1,alpha=0.7,label=f'CV Bin {i_p}')
         plt.xlabel(f"Total Elementary MC Steps"); plt.ylabel("Growth Stage Index")
         plt.title("Growth Stage vs. MC Steps (for selected CV Bins)");
         if all_mc_cycle_histories_dict : plt.legend(markerscale=5); plt.grid(True); plt.tight_layout()
         plt.savefig(os.path.join(sim_config.output_dir, "growth_stage_vs_mc_steps.png")); plt.show()
         
-        fe_calc_final = FreeEnergyCalculator_Cell4(sim_config); ref_bin = 0
+        ref_bin = 0
         while ref_bin < sim_config.num_cv_bins and ni_counts[ref_bin] == 0: ref_bin +=1
-        final_FEs = {}; delta_F_i1_plot = {}
+        final_FE_mat = None; delta_F_i1_plot = np.full(sim_config.num_cv_bins, np.inf)
         if ref_bin < sim_config.num_cv_bins :
-            n1_ref = ni_counts[ref_bin]; ni_dict = {i:c for i,c in enumerate(ni_counts)}
-            delta_F_i1_plot = fe_calc_final.calculate_delta_F_i1_initial(ni_dict,n1_ref)
-            ref_shift = delta_F_i1_plot.get(ref_bin,0.0)
-            if not np.isinf(ref_shift):
-                for k_idx in delta_F_i1_plot: 
-                    if not np.isinf(delta_F_i1_plot[k_idx]): delta_F_i1_plot[k_idx] -= ref_shift
-            final_FEs = fe_calc_final.combine_free_energies(all_F_ij_minus_F_i1, delta_F_i1_plot)
+            n1_ref = ni_counts[ref_bin]
+            delta_F_i1_plot = fe_calculator.calculate_delta_F_i1_initial(ni_counts,n1_ref)
+            ref_shift = delta_F_i1_plot[ref_bin]
+            if not np.isinf(ref_shift): delta_F_i1_plot[~np.isinf(delta_F_i1_plot)] -= ref_shift
+            final_FE_mat = fe_calculator.combine_free_energies(all_F_ij_minus_F_i1, delta_F_i1_plot) # NaN rows stay NaN for skipped bins
         plt.figure(figsize=(12,7)); lambda_ax = np.linspace(0,1,sim_config.num_growth_stages); plotted_count=0
+        cv_centers = sim_config.cv_min + (np.arange(sim_config.num_cv_bins) + 0.5) * (sim_config.cv_bin_width or 0.0) # All bin centers at once
         for i_p in plot_bins_indices:
-             if i_p in all_F_ij_minus_F_i1 and ni_counts[i_p]>0:
+             if simulated_bins[i_p] and ni_counts[i_p]>0:
                 f_prof=all_F_ij_minus_F_i1[i_p]
-                if f_prof is not None and not np.all(np.isnan(f_prof)):
-                    cv_val_center=sim_config.cv_min+(i_p+0.5)*sim_config.cv_bin_width if sim_config.cv_bin_width else sim_config.cv_min
-                    plt.plot(lambda_ax,f_prof,marker='o',ls='-',ms=3,label=f'CV Bin {i_p} ($R_g \sim {cv_val_center:.2f}$)')
+                if f_prof is not None and len(f_prof) and not (np.isnan(f_prof[0]) and np.isnan(f_prof).all()): # Profiles start at 0.0: full scan only if that is NaN
+                    plt.plot(lambda_ax,f_prof,marker='o',ls='-',ms=3,label=f'CV Bin {i_p} ($R_g \sim {cv_centers[i_p]:.2f}$)')
                     plotted_count+=1
         plt.xlabel("$\lambda$ (Growth Parameter)"); plt.ylabel("$F_i(\lambda)-F_i(0)$ (kBT units)")
         plt.title("$F_i(j)-F_i(1)$ vs Growth (Selected Bins)")
@@ -667,8 +1043,8 @@ def run_simulation_main_logic(config_obj): # Encapsulate main logic
         if plot_bins_indices and plot_bins_indices[0] in all_gee_attempt_details_log_dict:
             first_plotted_bin = plot_bins_indices[0]
             print(f"\n--- GEE Move Attempt Details for CV Bin {first_plotted_bin} (last up to 100 attempts) ---")
-            details_to_print = all_gee_attempt_details_log_dict[first_plotted_bin][-100:]
-            for entry in details_to_print: print(f"  Stp:{entry['step']}, {entry['from_j']}->{entry['to_k']}, dU:{entry['delta_U']:.2f}, eta_r:{entry['eta_ratio']:.2e}, exp(-bdU):{entry['boltzmann_factor']:.2e}, P_acc_walk:{entry['p_acc_biased_walk']:.2e}, log2c_walk:{entry['log2_corr_walk']:.2f}, factor_Ci:{entry.get('factor_for_Ci','N/A'):.2e}, Acc:{entry['accepted']}")
+            d = {name: col[-100:].tolist() for name, col in all_gee_attempt_details_log_dict[first_plotted_bin].items()} # Columns -> plain lists once
+            for i in range(len(d["step"])): print(f"  Stp:{d['step'][i]}, {d['from_j'][i]}->{d['to_k'][i]}, dU:{d['delta_U'][i]:.2f}, eta_r:{d['eta_ratio'][i]:.2e}, exp(-bdU):{d['boltzmann_factor'][i]:.2e}, P_acc_walk:{d['p_acc_biased_walk'][i]:.2e}, log2c_walk:{d['log2_corr_applied'][i]:.2f}, factor_Ci:{d['factor_for_Ci'][i]:.2e}, Acc:{d['accepted'][i]}")
         
         print("\n--- Simulation Performance Metrics ---")
         avg_s_acc = (cumulative_solvent_accepted / cumulative_solvent_attempted) * 100 if cumulative_solvent_attempted > 0 else 0
@@ -678,27 +1054,29 @@ def run_simulation_main_logic(config_obj): # Encapsulate main logic
         print(f"  Overall GEE Stage Transition Acceptance: {avg_g_acc:.2f}% ({cumulative_gee_accepted}/{cumulative_gee_attempted})")
 
         print("\n--- Final Condensed Collection Matrices ---")
-        for i_cb, C_list in all_C_i_condensed_dict.items():
+        for i_cb in np.flatnonzero(simulated_bins):
             if ni_counts[i_cb] > 0 :
-                print(f"CV Bin {i_cb}:"); C_np = np.array(C_list)
-                for s_j in range(sim_config.num_growth_stages): print(f"  S {s_j:2d}: C(j-1)={C_np[s_j,0]:<10.2f} C(j)={C_np[s_j,1]:<10.2f} C(j+1)={C_np[s_j,2]:<10.2f}")
-                print("-" * 70)
+                C_list = all_C_i_condensed[i_cb].tolist()
+                lines = [f"  S {s_j:2d}: C(j-1)={c0:<10.2f} C(j)={c1:<10.2f} C(j+1)={c2:<10.2f}" for s_j, (c0, c1, c2) in enumerate(C_list[:sim_config.num_growth_stages])]
+                sys.stdout.write(f"CV Bin {i_cb}:\n" + "\n".join(lines) + "\n" + "-" * 70 + "\n") # One write per bin
         
         output_summary_path = os.path.join(sim_config.output_dir, "tmmc_summary_data.json")
         try: 
-            s_Fij_m_Fi1 = {str(k): (v.tolist() if isinstance(v,np.ndarray) else v) for k,v in all_F_ij_minus_F_i1.items()}
-            s_dFi1 = {str(k):v for k,v in delta_F_i1_values_plot.items()}
-            s_finalFE = {str(k): (v.tolist() if isinstance(v,np.ndarray) else v) for k,v in final_FEs.items()}
-            config_to_save = {k: v for k, v in vars(sim_config).items() if not k.startswith('_') and not callable(v) and k != 'KB' and not isinstance(v, type(plt)) and k not in ['gee_attempt_details_log','mc_cycle_history_log']}
-            if 'KB_REDUCED' in config_to_save: del config_to_save['KB_REDUCED']
-            summary_data = {"F_ij_minus_F_i1_profiles": s_Fij_m_Fi1, "delta_F_i1_values_vs_F_ref1": s_dFi1, "final_FE_profiles_DeltaFij_vs_F_ref1": s_finalFE,
-                            "collection_matrices_condensed": all_C_i_condensed_dict, "visit_histograms": all_visits_dict,
-                            "ni_counts_per_bin": ni_counts.tolist(), "performance_metrics": {"proc_bins": processed_bins_count, 
-                            "solv_att": cumulative_solvent_attempted, "solv_acc": cumulative_solvent_accepted,
-                            "gee_att": cumulative_gee_attempted, "gee_acc": cumulative_gee_accepted},
-                            "config_used": config_to_save,
-                            "gee_attempt_details_first_plotted_bin": all_gee_attempt_details_log_dict.get(plot_bins_indices[0] if plot_bins_indices else -1, [])[-100:] }
-            with open(output_summary_path, 'w') as f: json.dump(summary_data, f, indent=2, cls=NpEncoder)
+            def summary_fields(): # Each top-level field is built only when it is about to be written
+                done_bins = np.flatnonzero(simulated_bins).tolist() # Rows are dict-ified per simulated bin only here, at the file boundary
+                yield "F_ij_minus_F_i1_profiles", {str(k): all_F_ij_minus_F_i1[k].tolist() for k in done_bins}
+                yield "delta_F_i1_values_vs_F_ref1", {str(k):v for k,v in enumerate(delta_F_i1_plot.tolist())}
+                yield "final_FE_profiles_DeltaFij_vs_F_ref1", {str(k): final_FE_mat[k].tolist() for k in done_bins} if final_FE_mat is not None else {}
+                yield "collection_matrices_condensed", {str(k): all_C_i_condensed[k].tolist() for k in done_bins}
+                yield "visit_histograms", {str(k): all_visits[k].tolist() for k in done_bins}
+                yield "ni_counts_per_bin", ni_counts.tolist()
+                yield "performance_metrics", {"proc_bins": processed_bins_count,
+                                              "solv_att": cumulative_solvent_attempted, "solv_acc": cumulative_solvent_accepted,
+                                              "gee_att": cumulative_gee_attempted, "gee_acc": cumulative_gee_accepted}
+                config_keys = getattr(sim_config, '_serializable_keys', None) or _serializable_config_keys(sim_config) # Configs not built by load_simulation_config
+                yield "config_used", {k: getattr(sim_config, k) for k in config_keys}
+                yield "gee_attempt_details_first_plotted_bin", {name: col[-100:] for name, col in all_gee_attempt_details_log_dict.get(plot_bins_indices[0] if plot_bins_indices else -1, {}).items()}
+            write_json_summary(output_summary_path, summary_fields())
             print(f"Saved all summary data to {output_summary_path}")
         except Exception as e: print(f"Error saving summary JSON: {e}")
     else: print("No data processed or library index was empty. Skipping further analysis.")